@@ -5,130 +5,309 @@ logger.add('logs/main.log', format='{time} {level} {message}', level='DEBUG', ro
 
 import argparse
 from collections import Counter, defaultdict
+from contextlib import suppress
+from functools import lru_cache
+import heapq
+import os
 import re
+import shutil
+import tempfile
+
+# matches punctuation, i.e. anything that is not a word character or whitespace
+_PUNCT_RE = re.compile(r'[^\w\s]')
 
 
 def get_word_freq_dict(filename):
     # read file
-    fstream = open(filename, 'r')
-    vocab = defaultdict(int)
-
-    for line in fstream:
-        line = line.strip('\r\n ')
-
-        # remove punctuation
-        line = re.sub(r'[^\w\s]', '', line)
-    
-        # convert to lowercase
-        line = line.lower()
-    
-        # split into words
-        words = line.split()
-        
-        # create a dictionary
-        word_dict = Counter(words)
-
-        for word, freq in word_dict.items():
-            vocab[word] += freq
-
-    fstream.close()
+    with open(filename, 'r') as fstream:
+        text = fstream.read()
+
+    # remove punctuation, convert to lowercase and split into words
+    words = _PUNCT_RE.sub('', text).lower().split()
+
+    # create a dictionary
+    vocab = Counter(words)
+
     logger.info('Read file: {}'.format(filename))
     logger.info('Vocab size: {}'.format(len(vocab)))
     return vocab
 
 
-def get_stats(vocab):
+def get_stats(words, freqs):
     """
-    Returns a stats and indices dictionary for the given vocabulary.
-    Stats is a dictionary with tuple(letter_1, letter_2) as key and frequency as value.
-    TODO: Indices I will fill later.
+    Returns a stats and indices dictionary for the given vocabulary,
+    stored as a list of words and a parallel list of their frequencies.
+    Stats is a dictionary with the packed pair (letter_1 << 32 | letter_2) as key and frequency as value.
+    Indices is a dictionary with the packed pair as key and the set of indices
+    of the words that contain the pair as value.
     """
     stats = defaultdict(int)
-    indices = defaultdict(dict)
+    indices = defaultdict(set)
 
-    for i, (word, freq) in enumerate(vocab):
+    for i, word in enumerate(words):
+        freq = freqs[i]
         for prev_char, curr_char in zip(word, word[1:]):
-            stats[(prev_char, curr_char)] += freq
-
-            # get cnt of each pair for each word
-            cnt = indices[(prev_char, curr_char)].get(i, 0)
-            indices[(prev_char, curr_char)][i] = cnt + 1
+            pair = prev_char << 32 | curr_char
+            stats[pair] += freq
+            indices[pair].add(i)
 
     return stats, indices
 
 
-def replace_string(vocab, pair, indices):
+def replace_string(words, freqs, pair, new_sym, stats, indices):
+    """
+    Merge every occurrence of pair in words into the symbol new_sym.
+    Stats and indices are updated in place with the pairs destroyed and created
+    by the merge, so they never have to be recomputed from scratch.
+    Words are not removed from indices when they lose a pair, so a word
+    listed there may no longer contain it.
+    Returns the set of pairs whose frequency went up.
+    """
+    first_sym, second_sym = pair >> 32, pair & 0xFFFFFFFF
+    increased = set()
+
+    for j in indices.pop(pair):
+        word = words[j]
+        freq = freqs[j]
+        deltas = defaultdict(int)
+        new_word = []
+        merged = False  # whether new_word[-1] was created by this merge
+
+        i = 0
+        n = len(word)
+        while i < n:
+            # find the next occurrence of the pair, the symbols before it are copied as is
+            k = i
+            while k < n - 1 and not (word[k] == first_sym and word[k + 1] == second_sym):
+                k += 1
+            if k == n - 1:
+                k = n
+
+            if k > i:
+                # "BC D": (BC, D) is created
+                if merged:
+                    deltas[new_sym << 32 | word[i]] += 1
+                new_word.extend(word[i:k])
+                merged = False
+                if k == n:
+                    break
+
+            if new_word:
+                # "A B C" -> "A BC": (A, B) is destroyed and (A, BC) is created.
+                # for "B C B C" the left pair (C, B) was already destroyed
+                # as the right pair of the previous merge.
+                if not merged:
+                    deltas[new_word[-1] << 32 | first_sym] -= 1
+                deltas[new_word[-1] << 32 | new_sym] += 1
+
+            # "B C D" -> "BC D": (C, D) is destroyed
+            if k + 2 < n:
+                deltas[second_sym << 32 | word[k + 2]] -= 1
+
+            new_word.append(new_sym)
+            merged = True
+            i = k + 2
+
+        # the word lost the pair in an earlier merge
+        if len(new_word) == n:
+            continue
+        words[j] = tuple(new_word)
+
+        for p, delta in deltas.items():
+            if delta == 0 or p == pair:
+                continue
+            stats[p] += delta * freq
+            if delta > 0:
+                indices[p].add(j)
+                increased.add(p)
+
+    del stats[pair]
+    return increased
+
+
+def _first_occurrence(words, id2sym, pair, word_indices):
     """
-    Replace the first_sym with second_sym in the vocab.
+    Returns (word index, character offset) of the first occurrence of pair,
+    looking only at the words in word_indices.
     """
-    # Create a regex pattern that matches 'first_sym second_sym'
-    # with no non-whitespace characters just before and after.
-    first_sym, second_sym = pair
-    new_sym = ''.join(pair)
-    pattern = re.compile(r'(?<!\S)' + re.escape(f'{first_sym} {second_sym}') + r'(?!\S)')
+    first_sym, second_sym = pair >> 32, pair & 0xFFFFFFFF
+    for j in sorted(word_indices):
+        word = words[j]
+        offset = 0
+        for k in range(len(word) - 1):
+            if word[k] == first_sym and word[k + 1] == second_sym:
+                return j, offset
+            offset += len(id2sym[word[k]])
 
-    for j, _ in indices[pair].items():
-        word, freq = vocab[j]
-        x = ' '.join(word)
-        x = pattern.sub(new_sym, x)
-        word = tuple(x.split(' '))
-        vocab[j] = (word, freq)
 
+def _write_atomic(filename, data):
+    """
+    Write data to filename through a temporary file,
+    so a reader never sees a partially written file.
+    """
+    # a uniquely named temporary file next to filename, so concurrent writers do not
+    # share it and os.replace stays on the same filesystem
+    dirname = os.path.dirname(os.path.abspath(filename))
+    f = tempfile.NamedTemporaryFile('w', dir=dirname, prefix=os.path.basename(filename) + '.', delete=False)
+    try:
+        with f:
+            f.write(data)
+
+        # NamedTemporaryFile is private to the user. keep the mode of an existing file,
+        # a new file gets the default mode, which the kernel applies to a file created with 0o666
+        try:
+            shutil.copymode(filename, f.name)
+        except FileNotFoundError:
+            probe = f.name + '.mode'
+            os.close(os.open(probe, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+            try:
+                shutil.copymode(probe, f.name)
+            finally:
+                os.remove(probe)
+
+        os.replace(f.name, filename)
+    except BaseException:
+        # a failed cleanup must not hide the error of the write or rename
+        with suppress(OSError):
+            os.remove(f.name)
+        raise
 
 
 def learn_bpe():
     filename = 'shakespeare.txt'
     vocab = get_word_freq_dict(filename)
 
+    # keep words and their frequencies in two parallel lists, most frequent first.
+    # the order is fixed from here on, word indices stay valid for the whole run.
+    # an empty corpus gives empty lists, and no BPE operations below.
+    vocab = vocab.most_common()
+    words = [word for word, _ in vocab]
+    freqs = [freq for _, freq in vocab]
+
+    # give every symbol an int id, merging compares and hashes ints instead of strings
+    id2sym = sorted(set(''.join(words)) | {word[-1] + '</w>' for word in words})
+    sym2id = {sym: i for i, sym in enumerate(id2sym)}
+
     # add '</w>' to the end of each word
-    # and change the key from string to tuple(word[:-1], word[-1]+'</w>')
-    vocab = dict(((tuple(word[:-1])+ (word[-1]+'</w>', )), freq) for word, freq in vocab.items())
-    vocab = sorted(vocab.items(), key=lambda x: x[1], reverse=True)
+    # and change it from string to tuple(word[:-1], word[-1]+'</w>') of symbol ids
+    words = [tuple(sym2id[sym] for sym in word[:-1]) + (sym2id[word[-1] + '</w>'],) for word in words]
+
+    # get stats once, replace_string keeps them up to date after each merge
+    stats, indices = get_stats(words, freqs)
+
+    # rank of a pair is (word index, character offset) of its first occurrence.
+    # ties go to the lowest rank, the pair a full rescan of the words meets first.
+    # before any merge only the last symbol of a word is longer than one character,
+    # so the symbol position is the character offset.
+    ranks = {}
+    for j, word in enumerate(words):
+        for k in range(len(word) - 1):
+            ranks.setdefault(word[k] << 32 | word[k + 1], (j, k))
+
+    # max-heap of (-freq, rank, pair). entries are not removed when a pair changes,
+    # they are checked against stats and ranks when they reach the top instead.
+    heap = [(-freq, ranks[pair], pair) for pair, freq in stats.items()]
+    heapq.heapify(heap)
 
     # BPE
     n_bpe_operations = 3000
+    # stop early once the most frequent pair is rarer than this,
+    # such merges add a token but almost no compression
+    min_freq = 2
     tokens = []
     for i in range(n_bpe_operations):
-        logger.info(f'BPE Operation: {i}')
-        # get stats
-        stats, indices = get_stats(vocab)
-
-        # sort stats
-        stats = sorted(stats.items(), key=lambda x: x[1], reverse=True)
-        pair = stats[0][0]
-        logger.info(f'Pair: {pair}')
-
-        # replace string
-        replace_string(vocab, pair, indices)
+        # pop the most frequent pair. an entry whose freq dropped since it was
+        # pushed goes back with the current freq and rank, other stale entries are dropped.
+        pair = None
+        while heap:
+            neg_freq, rank, candidate = heapq.heappop(heap)
+            freq = stats.get(candidate, 0)
+            if freq == -neg_freq and rank == ranks[candidate]:
+                pair = candidate
+                break
+            if 0 < freq < -neg_freq:
+                ranks[candidate] = _first_occurrence(words, id2sym, candidate, indices[candidate])
+                heapq.heappush(heap, (-freq, ranks[candidate], candidate))
+        if pair is None or freq < min_freq:
+            logger.info('Stopping after {} BPE operations, no pair occurs at least {} times', i, min_freq)
+            break
+        first_sym, second_sym = id2sym[pair >> 32], id2sym[pair & 0xFFFFFFFF]
+
+        # log progress only every 100 operations, this loop is the hot path
+        if i % 100 == 0:
+            logger.info('BPE Operation: {} Pair: {}', i, (first_sym, second_sym))
+
+        # the same string can be reached by different merges, reuse its id then
+        new_sym = first_sym + second_sym
+        if new_sym not in sym2id:
+            sym2id[new_sym] = len(id2sym)
+            id2sym.append(new_sym)
+
+        # replace string, only pairs that went up need a new heap entry
+        increased = replace_string(words, freqs, pair, sym2id[new_sym], stats, indices)
+        for p in increased:
+            if stats[p] > 0:
+                ranks[p] = _first_occurrence(words, id2sym, p, indices[p])
+                heapq.heappush(heap, (-stats[p], ranks[p], p))
 
         # add pair to tokens
-        tokens.append(''.join(pair))
+        tokens.append(new_sym)
 
+    logger.info('Learned {} tokens', len(tokens))
     tokens.sort(key=len, reverse=True)
-    with open('bpe_tokens.txt', 'w') as f:
-        f.write('\n'.join(tokens))
+    _write_atomic('bpe_tokens.txt', '\n'.join(tokens))
 
+    # the tokens changed, encode has to load them again
+    _load_trie.cache_clear()
 
-def _get_token(tokens: list[str], word: str):
+
+def _build_trie(tokens: list[str]):
     """
-    Get the token for the given word.
+    Build a prefix tree of the given tokens.
+    Every node is a dictionary from a character to the next node,
+    a node where a token ends also holds that token under the None key.
     """
+    trie = {}
     for token in tokens:
-        len_token = len(token)
-        if word[:len_token] == token:
-            return token
-    return '[UNK]'
+        node = trie
+        for char in token:
+            node = node.setdefault(char, {})
+        node[None] = token
+    return trie
 
 
-def encode(text: str):
+def _get_token(trie: dict, word: str):
     """
-    Encode the given text using the BPE tokens.
+    Get the token for the given word, i.e. the longest token it starts with.
+    """
+    token = '[UNK]'
+    node = trie
+    for char in word:
+        node = node.get(char)
+        if node is None:
+            break
+        token = node.get(None, token)
+    return token
+
+
+@lru_cache(maxsize=None)
+def _load_trie():
+    """
+    Load the BPE tokens and build their prefix tree, once per process.
     """
     with open('bpe_tokens.txt', 'r') as f:
         tokens = f.read().split('\n')
+    return _build_trie(tokens)
+
+
+def encode(text: str):
+    """
+    Encode the given text using the BPE tokens.
+    """
+    trie = _load_trie()
 
     # remove punctuation
-    text = re.sub(r'[^\w\s]', '', text)
+    text = _PUNCT_RE.sub('', text)
 
     # convert to lowercase
     text = text.lower()
@@ -143,7 +322,7 @@ def encode(text: str):
     encoded_words = []
     for word in words:
         while True:
-            token = _get_token(tokens, word)
+            token = _get_token(trie, word)
             encoded_words.append(token)
             word = word[len(token):]
 